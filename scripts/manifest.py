@@ -11,10 +11,15 @@ Usage:
 
 from __future__ import annotations
 
+import copy
+import functools
+import json
+import os
 import subprocess
 import socket
 import sys
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timezone
 from dataclasses import dataclass, field
@@ -50,6 +55,19 @@ class SystemState:
     copr_repos: set[str] = field(default_factory=set)
 
 
+@dataclass
+class Drift:
+    """Differences between a host's manifest and the live system."""
+    manifest: dict
+    state: SystemState
+    declared_pkgs: set[str]       # system + optional
+    missing: set[str]             # declared but not installed
+    extra: set[str]               # installed but not declared or excluded
+    missing_system: set[str]      # 'system' packages apply would install
+    missing_flatpaks: set[str]
+    extra_flatpaks: set[str]
+
+
 def get_hostname() -> str:
     return socket.gethostname()
 
@@ -59,6 +77,24 @@ def run_cmd(cmd: list[str], check: bool = True) -> subprocess.CompletedProcess:
     return subprocess.run(cmd, capture_output=True, text=True, check=check)
 
 
+# Parsed manifests keyed on (path, mtime) so repeated loads in one
+# process skip the TOML parse. Callers get their own copy to mutate.
+_manifest_cache: dict[Path, tuple[int, dict]] = {}
+
+
+def _ensure_schema(manifest: dict) -> dict:
+    """Guarantee every section downstream code indexes into exists."""
+    manifest.setdefault("meta", {})
+    packages = manifest.setdefault("packages", {})
+    packages.setdefault("system", [])
+    packages.setdefault("optional", [])
+    packages.setdefault("groups", [])
+    manifest.setdefault("flatpak", {}).setdefault("packages", [])
+    manifest.setdefault("copr", {}).setdefault("repos", [])
+    manifest.setdefault("excluded", {}).setdefault("packages", [])
+    return manifest
+
+
 def load_manifest(hostname: str) -> dict:
     """Load manifest for a host, or return empty template."""
     path = MANIFESTS_DIR / f"{hostname}.toml"
@@ -74,112 +110,197 @@ def load_manifest(hostname: str) -> dict:
             "copr": {"repos": []},
             "excluded": {"packages": []},
         }
+    st = path.stat()
+    cached = _manifest_cache.get(path)
+    if cached is not None and cached[0] == st.st_mtime_ns:
+        return copy.deepcopy(cached[1])
     with open(path, "rb") as f:
-        return tomllib.load(f)
+        manifest = _ensure_schema(tomllib.load(f))
+    _manifest_cache[path] = (st.st_mtime_ns, manifest)
+    return copy.deepcopy(manifest)
 
 
 def save_manifest(hostname: str, manifest: dict) -> None:
-    """Save manifest to file."""
+    """Save manifest to file, atomically via a temp file."""
     manifest["meta"]["updated"] = datetime.now(timezone.utc).isoformat()
     path = MANIFESTS_DIR / f"{hostname}.toml"
-    with open(path, "wb") as f:
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
         tomli_w.dump(manifest, f)
+    os.replace(tmp, path)
+    _manifest_cache.pop(path, None)
     print(f"Saved {path}")
 
 
-def get_system_state() -> SystemState:
-    """Query current system for installed packages."""
-    state = SystemState()
+_system_state_cache: SystemState | None = None
+
 
-    # DNF user-installed packages
+def _query_packages() -> set[str]:
+    """DNF user-installed packages.
+
+    --cacheonly skips the metadata refresh (the slow part of repoquery);
+    retry without it if the cache is cold.
+    """
     try:
-        result = run_cmd(["dnf", "repoquery", "--userinstalled", "--qf", "%{name}"])
-        state.packages = set(result.stdout.strip().split("\n")) - {""}
+        result = run_cmd(
+            ["dnf", "repoquery", "--userinstalled", "--qf", "%{name}", "--cacheonly"],
+            check=False,
+        )
+        if result.returncode != 0:
+            result = run_cmd(["dnf", "repoquery", "--userinstalled", "--qf", "%{name}"])
+        return set(filter(None, result.stdout.splitlines()))
     except (subprocess.CalledProcessError, FileNotFoundError):
         print("Warning: Could not query DNF packages", file=sys.stderr)
-
-    # DNF groups
+        return set()
+
+
+def _query_groups() -> set[str]:
+    """Installed DNF groups, read from dnf's own state file when possible."""
+    groups: set[str] = set()
+    groups_json = Path("/var/lib/dnf/groups.json")
+    if groups_json.exists():
+        try:
+            with open(groups_json) as f:
+                installed = json.load(f).get("GROUPS", {})
+            for group_id in installed:
+                # Normalize group names
+                groups.add(group_id.lower().replace(" ", "-"))
+            return groups
+        except (OSError, ValueError, AttributeError):
+            pass
     try:
         result = run_cmd(["dnf", "group", "list", "--installed", "-q"], check=False)
-        for line in result.stdout.strip().split("\n"):
+        for line in result.stdout.splitlines():
             line = line.strip()
             if line and not line.startswith("Installed"):
                 # Normalize group names
-                state.groups.add(line.lower().replace(" ", "-"))
+                groups.add(line.lower().replace(" ", "-"))
     except FileNotFoundError:
         pass
+    return groups
 
-    # Flatpaks
+
+def _query_flatpaks() -> set[str]:
+    """Installed Flatpak application IDs."""
     try:
         result = run_cmd(["flatpak", "list", "--app", "--columns=application"], check=False)
         if result.returncode == 0:
-            state.flatpaks = set(result.stdout.strip().split("\n")) - {""}
+            return set(filter(None, result.stdout.splitlines()))
     except FileNotFoundError:
         pass
+    return set()
 
-    # COPR repos
-    copr_dir = Path("/etc/yum.repos.d")
-    if copr_dir.exists():
-        for f in copr_dir.glob("_copr*.repo"):
-            name = f.stem.replace("_copr:", "").replace("_copr_", "")
-            state.copr_repos.add(name)
 
+def _scan_copr_repos() -> set[str]:
+    """Enabled COPR repos, from their repo files."""
+    repos: set[str] = set()
+    try:
+        with os.scandir("/etc/yum.repos.d") as it:
+            for entry in it:
+                name = entry.name
+                if name.startswith("_copr") and name.endswith(".repo"):
+                    stem = name[:-len(".repo")]
+                    repos.add(stem.removeprefix("_copr:").removeprefix("_copr_"))
+    except FileNotFoundError:
+        pass
+    return repos
+
+
+def get_system_state() -> SystemState:
+    """Query current system for installed packages (cached per process)."""
+    global _system_state_cache
+    if _system_state_cache is not None:
+        return _system_state_cache
+
+    # The probes are independent external commands / file reads, so run
+    # them concurrently; wall time is the slowest probe, not the sum.
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        f_packages = ex.submit(_query_packages)
+        f_groups = ex.submit(_query_groups)
+        f_flatpaks = ex.submit(_query_flatpaks)
+        f_copr = ex.submit(_scan_copr_repos)
+        state = SystemState(
+            packages=f_packages.result(),
+            groups=f_groups.result(),
+            flatpaks=f_flatpaks.result(),
+            copr_repos=f_copr.result(),
+        )
+
+    _system_state_cache = state
     return state
 
 
-def status(hostname: str) -> int:
-    """Show drift between manifest and system."""
+@functools.lru_cache(maxsize=4)
+def compute_drift(hostname: str) -> Drift:
+    """Compare a host's manifest against the system, once per process."""
     manifest = load_manifest(hostname)
     state = get_system_state()
 
-    # Collect declared packages
-    declared_pkgs = set(manifest.get("packages", {}).get("system", []))
-    declared_pkgs |= set(manifest.get("packages", {}).get("optional", []))
-    excluded = set(manifest.get("excluded", {}).get("packages", []))
+    declared_system = set(manifest["packages"]["system"])
+    declared_pkgs = declared_system | set(manifest["packages"]["optional"])
+    excluded = set(manifest["excluded"]["packages"])
+    declared_flatpaks = set(manifest["flatpak"]["packages"])
+
+    return Drift(
+        manifest=manifest,
+        state=state,
+        declared_pkgs=declared_pkgs,
+        missing=declared_pkgs - state.packages,
+        extra=state.packages - declared_pkgs - excluded,
+        missing_system=declared_system - state.packages,
+        missing_flatpaks=declared_flatpaks - state.flatpaks,
+        extra_flatpaks=state.flatpaks - declared_flatpaks,
+    )
 
-    missing = declared_pkgs - state.packages
-    extra = state.packages - declared_pkgs - excluded
 
-    print(f"Host: {hostname}")
-    print(f"Manifest packages: {len(declared_pkgs)}")
-    print(f"System packages: {len(state.packages)}")
-    print()
+def status(hostname: str) -> int:
+    """Show drift between manifest and system."""
+    drift = compute_drift(hostname)
+    missing = drift.missing
+    extra = drift.extra
+
+    # Collect the report and emit it with one write instead of a
+    # syscall-per-line print loop.
+    out = [
+        f"Host: {hostname}",
+        f"Manifest packages: {len(drift.declared_pkgs)}",
+        f"System packages: {len(drift.state.packages)}",
+        "",
+    ]
 
     if missing:
-        print(f"❌ Missing from system ({len(missing)}):")
-        for p in sorted(missing):
-            print(f"  - {p}")
-        print()
+        out.append(f"❌ Missing from system ({len(missing)}):")
+        out.extend(f"  - {p}" for p in sorted(missing))
+        out.append("")
 
     if extra:
-        print(f"➕ Extra on system, not in manifest ({len(extra)}):")
-        for p in sorted(extra)[:30]:
-            print(f"  + {p}")
+        out.append(f"➕ Extra on system, not in manifest ({len(extra)}):")
+        out.extend(f"  + {p}" for p in sorted(extra)[:30])
         if len(extra) > 30:
-            print(f"  ... and {len(extra) - 30} more")
-        print()
+            out.append(f"  ... and {len(extra) - 30} more")
+        out.append("")
 
     # Flatpaks
-    declared_flatpaks = set(manifest.get("flatpak", {}).get("packages", []))
-    missing_flatpaks = declared_flatpaks - state.flatpaks
-    extra_flatpaks = state.flatpaks - declared_flatpaks
+    missing_flatpaks = drift.missing_flatpaks
+    extra_flatpaks = drift.extra_flatpaks
 
     if missing_flatpaks:
-        print(f"❌ Missing flatpaks ({len(missing_flatpaks)}):")
-        for p in sorted(missing_flatpaks):
-            print(f"  - {p}")
-        print()
+        out.append(f"❌ Missing flatpaks ({len(missing_flatpaks)}):")
+        out.extend(f"  - {p}" for p in sorted(missing_flatpaks))
+        out.append("")
 
     if extra_flatpaks:
-        print(f"➕ Extra flatpaks ({len(extra_flatpaks)}):")
-        for p in sorted(extra_flatpaks):
-            print(f"  + {p}")
-        print()
+        out.append(f"➕ Extra flatpaks ({len(extra_flatpaks)}):")
+        out.extend(f"  + {p}" for p in sorted(extra_flatpaks))
+        out.append("")
 
-    if not missing and not extra and not missing_flatpaks:
-        print("✓ System matches manifest")
-        return 0
+    clean = not missing and not extra and not missing_flatpaks
+    if clean:
+        out.append("✓ System matches manifest")
+    sys.stdout.write("\n".join(out) + "\n")
 
+    if clean:
+        return 0
     return 1 if missing or missing_flatpaks else 0
 
 
@@ -189,9 +310,9 @@ def pull(hostname: str) -> None:
     state = get_system_state()
 
     # Get current manifest state
-    current_system = set(manifest.get("packages", {}).get("system", []))
-    current_optional = set(manifest.get("packages", {}).get("optional", []))
-    excluded = set(manifest.get("excluded", {}).get("packages", []))
+    current_system = set(manifest["packages"]["system"])
+    current_optional = set(manifest["packages"]["optional"])
+    excluded = set(manifest["excluded"]["packages"])
 
     # New packages go to optional by default
     all_declared = current_system | current_optional
@@ -204,17 +325,15 @@ def pull(hostname: str) -> None:
         if len(new_packages) > 15:
             print(f"  ... and {len(new_packages) - 15} more")
 
-        manifest.setdefault("packages", {})
         manifest["packages"]["optional"] = sorted(current_optional | new_packages)
 
     # Update flatpaks
-    current_flatpaks = set(manifest.get("flatpak", {}).get("packages", []))
+    current_flatpaks = set(manifest["flatpak"]["packages"])
     new_flatpaks = state.flatpaks - current_flatpaks
     if new_flatpaks:
         print(f"Adding {len(new_flatpaks)} new flatpaks:")
         for p in sorted(new_flatpaks):
             print(f"  + {p}")
-        manifest.setdefault("flatpak", {})
         manifest["flatpak"]["packages"] = sorted(current_flatpaks | new_flatpaks)
 
     save_manifest(hostname, manifest)
@@ -222,18 +341,15 @@ def pull(hostname: str) -> None:
 
 def apply(hostname: str, dry_run: bool = False) -> None:
     """Install missing packages from manifest."""
-    manifest = load_manifest(hostname)
-    state = get_system_state()
+    drift = compute_drift(hostname)
 
     # Only apply 'system' packages (not optional)
-    declared_pkgs = set(manifest.get("packages", {}).get("system", []))
-    missing = declared_pkgs - state.packages
+    missing = drift.missing_system
 
-    declared_groups = set(manifest.get("packages", {}).get("groups", []))
+    declared_groups = set(drift.manifest["packages"]["groups"])
     # Groups are harder to compare; skip for now
 
-    declared_flatpaks = set(manifest.get("flatpak", {}).get("packages", []))
-    missing_flatpaks = declared_flatpaks - state.flatpaks
+    missing_flatpaks = drift.missing_flatpaks
 
     if not missing and not missing_flatpaks:
         print("✓ Nothing to install")
@@ -253,8 +369,18 @@ def apply(hostname: str, dry_run: bool = False) -> None:
             print(f"  {p}")
 
         if not dry_run:
-            for flatpak in sorted(missing_flatpaks):
-                subprocess.run(["flatpak", "install", "-y", flatpak], check=True)
+            # One invocation amortizes flatpak's client startup and lets it
+            # resolve dependencies once; fall back to per-package installs
+            # so a single bad ref doesn't abort the whole batch.
+            result = subprocess.run(["flatpak", "install", "-y", *sorted(missing_flatpaks)])
+            if result.returncode != 0:
+                failed = []
+                for flatpak in sorted(missing_flatpaks):
+                    retry = subprocess.run(["flatpak", "install", "-y", flatpak])
+                    if retry.returncode != 0:
+                        failed.append(flatpak)
+                if failed:
+                    print(f"Warning: Could not install: {', '.join(failed)}", file=sys.stderr)
 
     if dry_run:
         print("\n(dry run, no changes made)")